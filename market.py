@@ -1,145 +1,168 @@
-import datetime
+import asyncio
 import logging.config
+import time
 from environs import Env
 from seller import download_stock
 
+import aiohttp
+import orjson
 import requests
 
-from seller import divide, price_conversion
+from seller import price_conversion, send_chunks
 
 logger = logging.getLogger(__file__)
 
+_ENDPOINT = "https://api.partner.market.yandex.ru/"
+_BASE_HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "Host": "api.partner.market.yandex.ru",
+}
 
-def get_product_list(page, campaign_id, access_token):
+
+def create_session(access_token):
+    """Создать сессию для запросов к магазину Яндекс-Маркет
+
+        На входе получает токен магазина.
+        Возвращает сессию aiohttp с заголовками авторизации.
+        Количество одновременных соединений ограничено.
+
+        Args:
+            access_token (str): токен магазина
+
+        Return:
+            aiohttp.ClientSession: сессия магазина Яндекс-Маркет
+
+    """
+    headers = {**_BASE_HEADERS, "Authorization": f"Bearer {access_token}"}
+    connector = aiohttp.TCPConnector(limit=20)
+    return aiohttp.ClientSession(headers=headers, connector=connector)
+
+
+async def get_product_list(page, campaign_id, session):
     """Получить список товаров магазина Яндекс-Маркет
 
-        На входе получает page последнего товара на странице, id компании и токен магазина.
+        На входе получает page последнего товара на странице, id компании
+        и сессию магазина.
         Возвращает список артикулов часов, созданный на основании запроса к магазину Яндекс-Маркет
 
         Args:
             page (str): страница перечня часов
             campaign_id (str): id компании
-            access_token (str): токен магазина
+            session (aiohttp.ClientSession): сессия магазина
 
         Return:
             offer_ids(list): список артикулов часов
 
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
     payload = {
         "page_token": page,
         "limit": 200,
     }
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
-    response.raise_for_status()
-    response_object = response.json()
+    url = _ENDPOINT + f"campaigns/{campaign_id}/offer-mapping-entries"
+    async with session.get(url, params=payload) as response:
+        response.raise_for_status()
+        response_object = await response.json(loads=orjson.loads)
     return response_object.get("result")
 
 
-def update_stocks(stocks, campaign_id, access_token):
+async def update_stocks(stocks, start, end, campaign_id, session):
     """Обновить остатки
 
-        На входе получает список остатков часов, id компании и токен магазина.
-        Обновляет список остатков в магазине Яндекс-Маркет.
-        Возвращает обновленный список остатков часов.
+        На входе получает список остатков часов, границы части списка,
+        id компании и сессию магазина. Обновляет список остатков
+        в магазине Яндекс-Маркет. Возвращает обновленный список остатков часов.
 
         Args:
             stocks (list): список остатков часов
+            start (int): начало части списка
+            end (int): конец части списка
             campaign_id (str): id клиента
-            access_token (str): токен магазина
+            session (aiohttp.ClientSession): сессия магазина
 
         Return:
             list: список остатков часов
 
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
-    payload = {"skus": stocks}
-    url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
+    payload = {"skus": stocks[start:end]}
+    url = _ENDPOINT + f"campaigns/{campaign_id}/offers/stocks"
+    async with session.put(url, data=orjson.dumps(payload)) as response:
+        response.raise_for_status()
+        response_object = await response.json(loads=orjson.loads)
     return response_object
 
 
-def update_price(prices, campaign_id, access_token):
+async def update_price(prices, start, end, campaign_id, session):
     """Обновить цены часов
 
-        На входе получает список цен на часы, id компании и токен магазина.
-        Обновляет цены в магазине Яндекс-Маркет.
-        Возвращает обновленный список цен часов.
+        На входе получает список цен на часы, границы части списка,
+        id компании и сессию магазина. Обновляет цены в магазине
+        Яндекс-Маркет. Возвращает обновленный список цен часов.
 
         Args:
             prices (list): список остатков часов
+            start (int): начало части списка
+            end (int): конец части списка
             campaign_id (str): id компании
-            access_token (str): токен магазина
+            session (aiohttp.ClientSession): сессия магазина
 
         Return:
             list: список цен
 
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
-    payload = {"offers": prices}
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
+    payload = {"offers": prices[start:end]}
+    url = _ENDPOINT + f"campaigns/{campaign_id}/offer-prices/updates"
+    async with session.post(url, data=orjson.dumps(payload)) as response:
+        response.raise_for_status()
+        response_object = await response.json(loads=orjson.loads)
     return response_object
 
 
-def get_offer_ids(campaign_id, market_token):
+async def get_offer_ids(campaign_id, session):
     """Получить артикулы товаров Яндекс маркета
 
-        На входе получает id компании и токен магазина.
+        На входе получает id компании и сессию магазина.
         Возвращает список артикулов часов, созданный на основании
-        списка часов.
+        списка часов. Запрос следующей страницы отправляется сразу после
+        получения nextPageToken текущей, пока разбирается текущая страница.
 
         Args:
             campaign_id (str): id клиента
-            market_token (str): токен магазина
+            session (aiohttp.ClientSession): сессия магазина
 
         Return:
             offer_ids(list): список артикулов часов
 
     """
-    page = ""
-    product_list = []
-    while True:
-        some_prod = get_product_list(page, campaign_id, market_token)
-        product_list.extend(some_prod.get("offerMappingEntries"))
-        page = some_prod.get("paging").get("nextPageToken")
-        if not page:
-            break
     offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer").get("shopSku"))
+    some_prod = await get_product_list("", campaign_id, session)
+    next_prod = None
+    try:
+        while True:
+            page = some_prod.get("paging").get("nextPageToken")
+            next_prod = None
+            if page:
+                next_prod = asyncio.create_task(
+                    get_product_list(page, campaign_id, session)
+                )
+            for product in some_prod.get("offerMappingEntries"):
+                offer_ids.append(product.get("offer").get("shopSku"))
+            if next_prod is None:
+                break
+            some_prod = await next_prod
+    finally:
+        if next_prod is not None and not next_prod.done():
+            next_prod.cancel()
     return offer_ids
 
 
-def create_stocks(watch_remnants, offer_ids, warehouse_id):
-    """Создать список словарей остатков часов
+def create_stocks_and_prices(watch_remnants, offer_ids, warehouse_id):
+    """Создать списки словарей остатков и цен на часы
 
-        На входе получает 2 списка: список часов и список артикулов.
-        Возвращает список словарей остатков часов, полученных из списка часов,
-        если такие часы есть в списке артикулов, с указанием количества остатков часов.
+        На входе получает 2 списка: список часов и список артикулов, и id склада.
+        За один проход по списку часов создает список словарей остатков часов,
+        список словарей цен для часов, которые есть в списке артикулов,
+        и список наличия часов.
 
         Args:
             watch_remnants (list): список часов
@@ -148,70 +171,39 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
 
         Return:
             stocks(list): список остатков часов
+            prices(list): список словарей цен
+            not_empty(list): список наличия часов
 
     """
     stocks = list()
-    date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
+    prices = list()
+    not_empty = list()
+    date = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    item_template = {"type": "FIT", "updatedAt": date}
+    seen = dict.fromkeys(offer_ids, False)
     for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append(
-                {
-                    "sku": str(watch.get("Код")),
-                    "warehouseId": warehouse_id,
-                    "items": [
-                        {
-                            "count": stock,
-                            "type": "FIT",
-                            "updatedAt": date,
-                        }
-                    ],
-                }
-            )
-            offer_ids.remove(str(watch.get("Код")))
-    for offer_id in offer_ids:
-        stocks.append(
+        code = str(watch.get("Код"))
+        if code not in seen or seen[code]:
+            continue
+        seen[code] = True
+        count = str(watch.get("Количество"))
+        if count == ">10":
+            stock = 100
+        elif count == "1":
+            stock = 0
+        else:
+            stock = int(count)
+        watch_stock = {
+            "sku": code,
+            "warehouseId": warehouse_id,
+            "items": [{"count": stock, **item_template}],
+        }
+        stocks.append(watch_stock)
+        if stock != 0:
+            not_empty.append(watch_stock)
+        prices.append(
             {
-                "sku": offer_id,
-                "warehouseId": warehouse_id,
-                "items": [
-                    {
-                        "count": 0,
-                        "type": "FIT",
-                        "updatedAt": date,
-                    }
-                ],
-            }
-        )
-    return stocks
-
-
-def create_prices(watch_remnants, offer_ids):
-    """Создать список словарей цены на товары
-
-        На входе получает 2 списка: список товаров и список артикулов.
-        Возвращает список словарей цены на товары, полученных из списка товаров,
-        если такой товара есть в списке артикулов.
-
-        Args:
-            watch_remnants (list): список часов
-            offer_ids (list): список артикулов
-
-        Return:
-            prices(list): список словарей цен
-
-    """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
+                "id": code,
                 # "feed": {"id": 0},
                 "price": {
                     "value": int(price_conversion(watch.get("Цена"))),
@@ -222,67 +214,92 @@ def create_prices(watch_remnants, offer_ids):
                 # "marketSku": 0,
                 # "shopSku": "string",
             }
-            prices.append(price)
-    return prices
+        )
+    zero_items = [{"count": 0, **item_template}]
+    for offer_id, matched in seen.items():
+        if not matched:
+            stocks.append(
+                {
+                    "sku": offer_id,
+                    "warehouseId": warehouse_id,
+                    "items": zero_items,
+                }
+            )
+    return stocks, prices, not_empty
 
 
-async def upload_prices(watch_remnants, campaign_id, market_token):
+async def upload_prices(prices, campaign_id, session):
     """Отправить цены на часы в магазин Яндекс-Маркет
 
-        На входе получает список часов, id компании и токен магазина.
+        На входе получает список цен на часы, id компании и сессию магазина.
         Обновляет список цен на часы, разделяя на части при загрузке
-        в магазин Яндекс_маркет. Возвращает обновленный список остатков часов.
+        в магазин Яндекс_маркет. Возвращает обновленный список цен на часы.
 
         Args:
-            watch_remnants (list): список остатков часов
+            prices (list): список цен на часы
             campaign_id (str): id компании
-            market_token (str): токен магазина
+            session (aiohttp.ClientSession): сессия магазина
 
         Return:
             prices (list): список цен на часы
 
         """
-    offer_ids = get_offer_ids(campaign_id, market_token)
-    prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
-        update_price(some_prices, campaign_id, market_token)
+    await send_chunks(update_price, prices, 500, campaign_id, session)
     return prices
 
 
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+async def upload_stocks(stocks, not_empty, campaign_id, session):
     """Отправить остатки в магазин Яндекс-Маркет.
 
-        На входе получает список часов, id компании и токен магазина.
-        Обновляет список остатков часов, разделяя на части при загрузке в магазин.
+        На входе получает список остатков часов, список наличия часов,
+        id компании и сессию магазина. Обновляет список остатков часов,
+        разделяя на части при загрузке в магазин.
         Возвращает обновленный список остатков часов и список наличия часов.
 
         Args:
-            watch_remnants (list): список остатков часов
+            stocks (list): список остатков часов
+            not_empty (list): список наличия часов
             campaign_id (str): id клиента
-            market_token (str): токен магазина
-            warehouse_id (str): id склада
+            session (aiohttp.ClientSession): сессия магазина
 
         Return:
             not_empty (list): список наличия часов
             stocks (list): список остатков часов
 
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
-    stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
-        update_stocks(some_stock, campaign_id, market_token)
-    not_empty = list(
-        filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
-    )
+    await send_chunks(update_stocks, stocks, 2000, campaign_id, session)
     return not_empty, stocks
 
 
-def main():
+async def process_campaign(watch_remnants, campaign_id, warehouse_id, session):
+    """Обновить остатки и цены для одной модели доставки
+
+        На входе получает список часов, id компании, id склада и сессию
+        магазина. Загружает артикулы компании, обновляет остатки и цены
+        в магазине Яндекс-Маркет.
+
+        Args:
+            watch_remnants (list): список остатков часов
+            campaign_id (str): id компании
+            warehouse_id (str): id склада
+            session (aiohttp.ClientSession): сессия магазина
+
+    """
+    offer_ids = await get_offer_ids(campaign_id, session)
+    stocks, prices, not_empty = create_stocks_and_prices(
+        watch_remnants, offer_ids, warehouse_id
+    )
+    await upload_stocks(stocks, not_empty, campaign_id, session)
+    await upload_prices(prices, campaign_id, session)
+
+
+async def _main_async():
     """Запустить скрипт
 
         Считывает переменные окружения. Загружает артикулы часов. Создает список
-        часов с сайта Casio. Создает список остатков. Для каждой модели доставки:
-        обновляет остатки, обновляет цены магазина Яндекс-Маркет.
+        часов с сайта Casio. Создает список остатков. Для каждой модели доставки
+        одновременно: обновляет остатки, обновляет цены магазина Яндекс-Маркет.
+        Ошибка одной модели доставки не прерывает обновление другой.
 
         Exceptions:
             ReadTimeout: превышено время ожидания
@@ -299,24 +316,38 @@ def main():
 
     watch_remnants = download_stock()
     try:
-        offer_ids = get_offer_ids(campaign_fbs_id, market_token)
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_fbs_id, market_token)
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
-
-        offer_ids = get_offer_ids(campaign_dbs_id, market_token)
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_dbs_id, market_token)
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
-    except requests.exceptions.ReadTimeout:
+        async with create_session(market_token) as session:
+            results = await asyncio.gather(
+                process_campaign(
+                    watch_remnants, campaign_fbs_id, warehouse_fbs_id, session
+                ),
+                process_campaign(
+                    watch_remnants, campaign_dbs_id, warehouse_dbs_id, session
+                ),
+                return_exceptions=True,
+            )
+        for campaign_id, result in zip((campaign_fbs_id, campaign_dbs_id), results):
+            if isinstance(result, Exception):
+                print(result, f"Ошибка обновления компании {campaign_id}")
+    except (requests.exceptions.ReadTimeout, asyncio.TimeoutError):
         print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
+    except (
+        requests.exceptions.ConnectionError,
+        aiohttp.ClientConnectionError,
+    ) as error:
         print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")
 
 
+def main():
+    """Запустить скрипт
+
+        Запускает _main_async в цикле событий asyncio.
+
+    """
+    asyncio.run(_main_async())
+
+
 if __name__ == "__main__":
     main()
@@ -1,37 +1,101 @@
+import asyncio
 import io
 import logging.config
 import os
+import pickle
 import re
+import tempfile
 import zipfile
 from environs import Env
 
-import pandas as pd
+import aiohttp
+import orjson
 import requests
+import xlrd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__file__)
 
+_ENDPOINT = "https://api-seller.ozon.ru/"
+_NON_DIGIT = re.compile("[^0-9]")
+_RETRY_STATUSES = [429, 502, 503, 504]
+_CACHE_DIR = os.path.dirname(os.path.abspath(__file__))
+_CASIO_CACHE = os.path.join(_CACHE_DIR, ".casio_cache.json")
+_CASIO_RECORDS = os.path.join(_CACHE_DIR, ".casio_cache.pickle")
+
+_session = requests.Session()
+_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=_RETRY_STATUSES,
+        ),
+    ),
+)
+
+
+def create_session(client_id, seller_token):
+    """Создать сессию для запросов к магазину Озон
 
-def get_product_list(last_id, client_id, seller_token):
-    """Получить список товаров магазина Озон
-
-        На входе получает id последнего товара на странице,
-        id клиента и токен магазина. Возвращает список артикулов часов,
-        созданный на основании запроса к магазину Озон
+        На входе получает id клиента и токен магазина.
+        Возвращает сессию aiohttp с заголовками авторизации.
+        Количество одновременных соединений ограничено.
 
         Args:
-            last_id (str): id товара
             client_id (str): id клиента
             seller_token (str): токен магазина
 
         Return:
-            offer_ids(list): список артикулов часов
+            aiohttp.ClientSession: сессия магазина Озон
 
     """
-    url = "https://api-seller.ozon.ru/v2/product/list"
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
+    connector = aiohttp.TCPConnector(limit=20)
+    return aiohttp.ClientSession(headers=headers, connector=connector)
+
+
+async def _post_json(session, url, payload):
+    """Отправить POST-запрос и вернуть ответ в виде словаря
+
+        Args:
+            session (aiohttp.ClientSession): сессия магазина
+            url (str): адрес запроса
+            payload (dict): тело запроса
+
+        Return:
+            dict: ответ магазина
+
+    """
+    async with session.post(url, data=orjson.dumps(payload)) as response:
+        response.raise_for_status()
+        return await response.json(loads=orjson.loads)
+
+
+async def get_product_list(last_id, session):
+    """Получить список товаров магазина Озон
+
+        На входе получает id последнего товара на странице и сессию
+        магазина. Возвращает список артикулов часов, созданный
+        на основании запроса к магазину Озон
+
+        Args:
+            last_id (str): id товара
+            session (aiohttp.ClientSession): сессия магазина
+
+        Return:
+            offer_ids(list): список артикулов часов
+
+    """
+    url = _ENDPOINT + "v2/product/list"
     payload = {
         "filter": {
             "visibility": "ALL",
@@ -39,185 +103,319 @@ def get_product_list(last_id, client_id, seller_token):
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    response_object = response.json()
+    response_object = await _post_json(session, url, payload)
     return response_object.get("result")
 
 
-def get_offer_ids(client_id, seller_token):
+async def get_offer_ids(session):
     """Получить артикулы товаров магазина Озон
 
-        На входе получает id клиента и токен магазина.
+        На входе получает сессию магазина.
         Возвращает список артикулов часов, созданный на основании
-        списка часов.
+        списка часов. Запрос следующей страницы отправляется сразу
+        после получения last_id текущей, пока разбирается текущая страница.
 
         Args:
-            client_id (str): id клиента
-            seller_token (str): токен магазина
+            session (aiohttp.ClientSession): сессия магазина
 
         Return:
             offer_ids(list): список артикулов часов
 
     """
-    last_id = ""
-    product_list = []
-    while True:
-        some_prod = get_product_list(last_id, client_id, seller_token)
-        product_list.extend(some_prod.get("items"))
-        total = some_prod.get("total")
-        last_id = some_prod.get("last_id")
-        if total == len(product_list):
-            break
     offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
+    some_prod = await get_product_list("", session)
+    next_prod = None
+    try:
+        while True:
+            products = some_prod.get("items")
+            total = some_prod.get("total")
+            next_prod = None
+            if products and len(offer_ids) + len(products) < total:
+                next_prod = asyncio.create_task(
+                    get_product_list(some_prod.get("last_id"), session)
+                )
+            for product in products:
+                offer_ids.append(product.get("offer_id"))
+            if next_prod is None:
+                break
+            some_prod = await next_prod
+    finally:
+        if next_prod is not None and not next_prod.done():
+            next_prod.cancel()
     return offer_ids
 
 
-def update_price(prices: list, client_id, seller_token):
+async def update_price(prices: list, start, end, session):
     """Обновить цены часов
 
-        На входе получает список цен на часы, id клиента и токен магазина.
-        Обновляет цены товаров, загруженных в магазин Озон.
-        Возвращает обновленный список цен часов.
+        На входе получает список цен на часы, границы части списка
+        и сессию магазина. Обновляет цены товаров, загруженных в магазин
+        Озон. Возвращает обновленный список цен часов.
 
         Args:
             prices (list): список остатков часов
-            client_id (str): id клиента
-            seller_token (str): токен магазина
+            start (int): начало части списка
+            end (int): конец части списка
+            session (aiohttp.ClientSession): сессия магазина
 
         Return:
             list: список цен часов
 
     """
-    url = "https://api-seller.ozon.ru/v1/product/import/prices"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
-    payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    url = _ENDPOINT + "v1/product/import/prices"
+    payload = {"prices": prices[start:end]}
+    return await _post_json(session, url, payload)
 
 
-def update_stocks(stocks: list, client_id, seller_token):
+async def update_stocks(stocks: list, start, end, session):
     """Обновить остатки
 
-        На входе получает список остатков часов, id клиента и токен магазина.
-        Обновляет список остатков часов, загруженных в магазин Озон.
-        Возвращает обновленный список остатков часов.
+        На входе получает список остатков часов, границы части списка
+        и сессию магазина. Обновляет список остатков часов, загруженных
+        в магазин Озон. Возвращает обновленный список остатков часов.
 
         Args:
             stocks (list): список остатков часов
-            client_id (str): id клиента
-            seller_token (str): токен магазина
+            start (int): начало части списка
+            end (int): конец части списка
+            session (aiohttp.ClientSession): сессия магазина
 
         Return:
             list: список остатков часов
 
     """
-    url = "https://api-seller.ozon.ru/v1/product/import/stocks"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
-    payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    url = _ENDPOINT + "v1/product/import/stocks"
+    payload = {"stocks": stocks[start:end]}
+    return await _post_json(session, url, payload)
 
 
 def download_stock():
     """Скачать файл ostatki с сайта casio
 
         Запрашивает с сайта casio файл c номенклатурой часов ostatki.zip.
-        Возвращает список номенклатуры часов, полученных из разархивированного
-        файла Excel. Удаляет файл ostatki.zip.
+        Возвращает список номенклатуры часов, полученных из файла Excel
+        внутри архива. Архив разбирается в памяти.
+
+        Запрос отправляется с заголовками If-Modified-Since и If-None-Match
+        из прошлого запуска. Если файл на сайте не изменился, список часов
+        берется из кеша рядом с модулем. Если кеш не читается, файл
+        запрашивается заново без условных заголовков.
 
         Return:
             watch_remnants(list): список остатков часов
 
     """
     casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
+    cache = _load_casio_cache()
+    headers = {}
+    if cache.get("last_modified"):
+        headers["If-Modified-Since"] = cache["last_modified"]
+    if cache.get("etag"):
+        headers["If-None-Match"] = cache["etag"]
+    response = _session.get(casio_url, headers=headers)
     response.raise_for_status()
-    with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
-
-    excel_file = "ostatki.xls"
-    watch_remnants = pd.read_excel(
-        io=excel_file,
-        na_values=None,
-        keep_default_na=False,
-        header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")
+    if response.status_code == 304:
+        watch_remnants = _load_casio_records(cache["records_path"])
+        if watch_remnants is not None:
+            return watch_remnants
+        response = _session.get(casio_url)
+        response.raise_for_status()
+    watch_remnants = _read_stock(response.content)
+    _save_casio_cache(response, watch_remnants)
     return watch_remnants
 
 
-def create_stocks(watch_remnants, offer_ids):
-    """Создать список словарей остатков часов
+def _load_casio_cache():
+    """Прочитать сведения о последней загрузке файла ostatki
 
-        На входе получает 2 списка: список часов и список артикулов
-        часов. Возвращает список словарей остатков часов,
-        полученных из списка часов, если такие часы есть в списке
-        артикулов, с указанием количества остатков часов.
+        Return:
+            dict: заголовки Last-Modified и ETag и путь к списку часов,
+                  пустой словарь, если кеша нет
+
+    """
+    try:
+        with open(_CASIO_CACHE, "rb") as cache_file:
+            cache = orjson.loads(cache_file.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    for key in ("last_modified", "etag"):
+        if not isinstance(cache.get(key), (str, type(None))):
+            return {}
+    records_path = cache.get("records_path")
+    if not isinstance(records_path, str) or not os.path.exists(records_path):
+        return {}
+    return cache
+
+
+def _load_casio_records(records_path):
+    """Прочитать сохраненный список часов
 
         Args:
-            watch_remnants (list): список часов
-            offer_ids (list): список артикулов
+            records_path (str): путь к файлу списка часов
 
         Return:
-            stocks(list): список остатков часов
+            watch_remnants(list): список остатков часов,
+                                  None, если файл поврежден
 
     """
-    stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
-    for offer_id in offer_ids:
-        stocks.append({"offer_id": offer_id, "stock": 0})
-    return stocks
-
-
-def create_prices(watch_remnants, offer_ids):
-    """Создать список словарей цены на часы
-
-        На входе получает 2 списка: список товаров и список артикулов.
-        Возвращает список словарей цены на товары, полученных из списка товаров,
-        если такой товара есть в списке артикулов.
+    try:
+        with open(records_path, "rb") as records_file:
+            watch_remnants = pickle.load(records_file)
+    except Exception as error:
+        logger.warning("Кеш остатков не прочитан: %s", error)
+        return None
+    if not isinstance(watch_remnants, list):
+        logger.warning("Кеш остатков не прочитан: неверный формат")
+        return None
+    return watch_remnants
+
+
+def _write_atomic(path, content):
+    """Записать файл целиком через временный файл
+
+        Args:
+            path (str): путь к файлу
+            content (bytes): содержимое файла
+
+    """
+    directory, name = os.path.split(path)
+    descriptor, temp_path = tempfile.mkstemp(prefix=name, dir=directory)
+    try:
+        with os.fdopen(descriptor, "wb") as temp_file:
+            temp_file.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def _save_casio_cache(response, watch_remnants):
+    """Сохранить список часов и заголовки ответа сайта casio
+
+        Если кеш не удается записать, в лог пишется предупреждение:
+        без кеша следующий запуск просто скачает файл заново.
+
+        Args:
+            response (requests.Response): ответ сайта casio
+            watch_remnants (list): список остатков часов
+
+    """
+    cache = {
+        "last_modified": response.headers.get("Last-Modified"),
+        "etag": response.headers.get("ETag"),
+        "records_path": _CASIO_RECORDS,
+    }
+    try:
+        _write_atomic(_CASIO_RECORDS, pickle.dumps(watch_remnants))
+        _write_atomic(_CASIO_CACHE, orjson.dumps(cache))
+    except OSError as error:
+        logger.warning("Кеш остатков не сохранен: %s", error)
+
+
+def _read_stock(content):
+    """Прочитать список часов из архива ostatki.zip
+
+        Args:
+            content (bytes): содержимое архива
+
+        Return:
+            watch_remnants(list): список остатков часов
+
+    """
+    archive = zipfile.ZipFile(io.BytesIO(content))
+    with archive:
+        book = xlrd.open_workbook(file_contents=archive.read("ostatki.xls"))
+    sheet = book.sheet_by_index(0)
+    headers = sheet.row_values(17)
+    code_column = headers.index("Код")
+    count_column = headers.index("Количество")
+    price_column = headers.index("Цена")
+    watch_remnants = []
+    for row_index in range(18, sheet.nrows):
+        row = sheet.row(row_index)
+        if all(cell.value == "" for cell in row):
+            continue
+        watch_remnants.append(
+            {
+                "Код": _cell_value(row[code_column]),
+                "Количество": _cell_value(row[count_column]),
+                "Цена": _cell_value(row[price_column]),
+            }
+        )
+    return watch_remnants
+
+
+def _cell_value(cell):
+    """Получить значение ячейки Excel
+
+        Целые числа, которые xlrd хранит как float, возвращаются как int,
+        чтобы артикул 12345.0 превращался в '12345'.
+
+        Args:
+            cell (xlrd.sheet.Cell): ячейка листа
+
+        Return:
+            значение ячейки
+
+    """
+    if cell.ctype == xlrd.XL_CELL_NUMBER and cell.value.is_integer():
+        return int(cell.value)
+    return cell.value
+
+
+def create_stocks_and_prices(watch_remnants, offer_ids):
+    """Создать списки словарей остатков и цен на часы
+
+        На входе получает 2 списка: список часов и список артикулов
+        часов. За один проход по списку часов создает список словарей
+        остатков часов, список словарей цен для часов, которые есть
+        в списке артикулов, и список наличия часов.
 
         Args:
             watch_remnants (list): список часов
             offer_ids (list): список артикулов
 
         Return:
+            stocks(list): список остатков часов
             prices(list): список словарей цен
+            not_empty(list): список наличия часов
 
     """
+    stocks = []
     prices = []
+    not_empty = []
+    seen = dict.fromkeys(offer_ids, False)
     for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
+        code = str(watch.get("Код"))
+        if code not in seen or seen[code]:
+            continue
+        seen[code] = True
+        count = str(watch.get("Количество"))
+        if count == ">10":
+            stock = 100
+        elif count == "1":
+            stock = 0
+        else:
+            stock = int(count)
+        watch_stock = {"offer_id": code, "stock": stock}
+        stocks.append(watch_stock)
+        if stock != 0:
+            not_empty.append(watch_stock)
+        prices.append(
+            {
                 "auto_action_enabled": "UNKNOWN",
                 "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
+                "offer_id": code,
                 "old_price": "0",
                 "price": price_conversion(watch.get("Цена")),
             }
-            prices.append(price)
-    return prices
+        )
+    for offer_id, matched in seen.items():
+        if not matched:
+            stocks.append({"offer_id": offer_id, "stock": 0})
+    return stocks, prices, not_empty
 
 
 def price_conversion(price: str) -> str:
@@ -234,7 +432,7 @@ def price_conversion(price: str) -> str:
             5990
 
     """
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    return _NON_DIGIT.sub("", price.split(".", 1)[0])
 
 
 def divide(lst: list, n: int):
@@ -258,57 +456,122 @@ def divide(lst: list, n: int):
         yield lst[i: i + n]
 
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+def divide_indices(length: int, n: int):
+    """Разделить список на части по индексам
+
+        Args:
+            length (int): длинна списка
+            n (int): длинна части
+
+        Return:
+            list: список пар (начало, конец) частей длинной n
+
+        Example:
+            '>>> 5
+            '>>> 2
+            '>>> [(0, 2), (2, 4), (4, 5)]
+
+    """
+    return [(i, min(i + n, length)) for i in range(0, length, n)]
+
+
+async def send_chunks(update, items, n, *args, concurrency=8, attempts=3):
+    """Отправить список в магазин параллельно частями длинной n
+
+        Вызывает update для границ каждой части списка, одновременно
+        отправляется не больше concurrency частей. Часть, на которую магазин
+        ответил 429 или 5xx, или которая не дошла из-за таймаута или обрыва
+        соединения, отправляется повторно. Ошибка одной части не прерывает
+        отправку остальных: она записывается в лог, а после отправки всех
+        частей первая ошибка выбрасывается.
+
+        Args:
+            update (coroutine function): функция обновления магазина
+            items (list): список остатков или цен
+            n (int): длинна части
+            *args: дополнительные аргументы update
+            concurrency (int): количество одновременных запросов
+            attempts (int): количество попыток для одной части
+
+        Return:
+            list: ответы магазина на части списка
+
+        Exceptions:
+            ClientResponseError: магазин отклонил часть списка
+            ClientConnectionError: ошибка соединения
+            TimeoutError: превышено время ожидания
+
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send_chunk(start, end):
+        async with semaphore:
+            for attempt in range(attempts):
+                try:
+                    return await update(items, start, end, *args)
+                except aiohttp.ClientResponseError as error:
+                    failure = error
+                    retry = error.status in _RETRY_STATUSES
+                except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as error:
+                    failure = error
+                    retry = True
+                if not retry or attempt == attempts - 1:
+                    logger.warning("Часть списка не отправлена: %s", failure)
+                    return failure
+                await asyncio.sleep(0.3 * 2 ** attempt)
+
+    results = await asyncio.gather(
+        *(send_chunk(start, end) for start, end in divide_indices(len(items), n))
+    )
+    failures = [result for result in results if isinstance(result, Exception)]
+    if failures:
+        raise failures[0]
+    return results
+
+
+async def upload_prices(prices, session):
     """Отправить цены на часы в магазин Озон
 
-        На входе получает список часов, id клиента и токен магазина.
+        На входе получает список цен на часы и сессию магазина.
         Обновляет список цен на часы, разделяя на части
         при загрузке в магазин Озон. Возвращает обновленный
-        список остатков часов.
+        список цен на часы.
 
         Args:
-            watch_remnants (list): список остатков часов
-            client_id (str): id клиента
-            seller_token (str): токен магазина
+            prices (list): список цен на часы
+            session (aiohttp.ClientSession): сессия магазина
 
         Return:
             prices (list): список цен на часы
 
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
-    prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    await send_chunks(update_price, prices, 900, session)
     return prices
 
 
-async def upload_stocks(watch_remnants, client_id, seller_token):
+async def upload_stocks(stocks, not_empty, session):
     """Отправить остатки в магазин Озон
 
-        На входе получает список часов, id клиента и токен магазина.
-        Обновляет список остатков часов, разделяя на части
-        при загрузке в магазин Озон. Возвращает обновленный список
-        остатков часов и список наличия часов.
+        На входе получает список остатков часов, список наличия часов
+        и сессию магазина. Обновляет список остатков часов, разделяя
+        на части при загрузке в магазин Озон. Возвращает обновленный
+        список остатков часов и список наличия часов.
 
         Args:
-            watch_remnants (list): список остатков часов
-            client_id (str): id клиента
-            seller_token (str): токен магазина
+            stocks (list): список остатков часов
+            not_empty (list): список наличия часов
+            session (aiohttp.ClientSession): сессия магазина
 
         Return:
             not_empty (list): список наличия часов
             stocks (list): список остатков часов
 
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
-    stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
-    not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
+    await send_chunks(update_stocks, stocks, 100, session)
     return not_empty, stocks
 
 
-def main():
+async def _main_async():
     """Запустить скрипт
 
         Считывает переменные окружения. Загружает артикулы часов. Создает список
@@ -325,21 +588,33 @@ def main():
     seller_token = env.str("SELLER_TOKEN")
     client_id = env.str("CLIENT_ID")
     try:
-        offer_ids = get_offer_ids(client_id, seller_token)
         watch_remnants = download_stock()
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
-    except requests.exceptions.ReadTimeout:
+        async with create_session(client_id, seller_token) as session:
+            offer_ids = await get_offer_ids(session)
+            stocks, prices, not_empty = create_stocks_and_prices(
+                watch_remnants, offer_ids
+            )
+            await upload_stocks(stocks, not_empty, session)
+            await upload_prices(prices, session)
+    except (requests.exceptions.ReadTimeout, asyncio.TimeoutError):
         print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
+    except (
+        requests.exceptions.ConnectionError,
+        aiohttp.ClientConnectionError,
+    ) as error:
         print(error, "Ошибка соединения")
     except Exception as error:
         print(error, "ERROR_2")
 
 
+def main():
+    """Запустить скрипт
+
+        Запускает _main_async в цикле событий asyncio.
+
+    """
+    asyncio.run(_main_async())
+
+
 if __name__ == "__main__":
     main()
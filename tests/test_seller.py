@@ -0,0 +1,51 @@
+import io
+import zipfile
+
+import pytest
+
+import seller
+
+pd = pytest.importorskip("pandas")
+xlwt = pytest.importorskip("xlwt")
+
+
+def make_ostatki_xls():
+    """Собрать ostatki.xls: пустые строки над шапкой и внутри данных"""
+    book = xlwt.Workbook()
+    sheet = book.add_sheet("ostatki")
+    sheet.write(2, 0, "Остатки на складе")
+    sheet.write(5, 1, "Casio")
+    for column, title in enumerate(["Код", "Наименование", "Количество", "Цена"]):
+        sheet.write(17, column, title)
+    rows = [
+        (12345, "G-SHOCK", ">10", "5'990.00 руб."),
+        (23456, "EDIFICE", 1, "12'500.00 руб."),
+        (34567, "BABY-G", 4, "7'990.00 руб."),
+    ]
+    for row_index, row in zip([18, 19, 21], rows):
+        for column, value in enumerate(row):
+            sheet.write(row_index, column, value)
+    excel_file = io.BytesIO()
+    book.save(excel_file)
+    return excel_file.getvalue()
+
+
+def test_read_stock_matches_read_excel():
+    excel_content = make_ostatki_xls()
+    archive_file = io.BytesIO()
+    with zipfile.ZipFile(archive_file, "w") as archive:
+        archive.writestr("ostatki.xls", excel_content)
+
+    expected = [
+        {key: record[key] for key in ("Код", "Количество", "Цена")}
+        for record in pd.read_excel(
+            io.BytesIO(excel_content),
+            na_values=None,
+            keep_default_na=False,
+            header=17,
+        ).to_dict(orient="records")
+        if any(value != "" for value in record.values())
+    ]
+
+    assert seller._read_stock(archive_file.getvalue()) == expected
+    assert len(expected) == 3